@@ -1,14 +1,74 @@
-from . import bitutil
+import argparse
+import atexit
 import json
+import mmap
+import os
 import struct
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from itertools import chain
+from math import isfinite
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class HkxException(ValueError):
+    pass
+
+# Compiled struct.Struct objects keyed by format string
+STRUCTS = {}
+
+def compile_struct(format):
+    compiled = STRUCTS.get(format)
+    if compiled is None:
+        compiled = STRUCTS[format] = struct.Struct(format)
+    return compiled
+
+U64_BE         = compile_struct(">Q")
+SECTION_HEADER = compile_struct(">I4s")
+ITEM_ENTRY     = compile_struct("<III")
+POINTER        = compile_struct("<Q")
+BOOL           = compile_struct("?")
+FLOAT          = compile_struct("<f")
+
+def build_varint_table():
+    """Map the first byte of a varint to its encoded size, the offset of the
+    big-endian u64 window holding its value, and the shift and mask that
+    extract the value from that window"""
+    table = [None] * 256
+    for msb in range(256):
+        mode = msb >> 3
+        if mode <= 15:
+            size, bits = 1, 7
+        elif mode <= 23:
+            size, bits = 2, 14
+        elif mode <= 27:
+            size, bits = 3, 21
+        elif mode == 28:
+            size, bits = 4, 27
+        elif mode == 29:
+            size, bits = 5, 35
+        elif mode == 30:
+            size, bits = 8, 59
+        elif (msb & 7) == 0:
+            size, bits = 6, 40
+        elif (msb & 7) == 1:
+            size, bits = 9, 64
+        else:
+            continue
+        # The 9 byte form is a marker byte followed by a whole u64
+        window = max(size - 8, 0)
+        shift = (8 - min(size, 8)) * 8
+        table[msb] = (size, window, shift, (1 << bits) - 1)
+    return table
 
-class HkxException(Exception):
-    def __init__(*args, **kwargs):
-        super.__init__(*args, **kwargs)
+VARINT_TABLE = build_varint_table()
 
 class BufferReader():
+    __slots__ = ('data', 'offset')
+
     def __init__(self, data, *, offset=0):
         self.data = data
         self.offset = offset
@@ -23,24 +83,90 @@ class BufferReader():
         return self.offset >= len(self.data)
 
     def unpack(self, format, *, peek=False, offset=0):
-        # Allow partial overread for varint decoding
+        compiled = STRUCTS.get(format)
+        if compiled is None:
+            compiled = compile_struct(format)
+        return self.unpack_struct(compiled, peek=peek, offset=offset)
+
+    def unpack_struct(self, compiled, *, peek=False, offset=0):
+        """unpack() with an already compiled struct.Struct"""
         start = self.offset + offset
-        if start >= len(self.data):
-            raise IndexError
-        end = start + struct.calcsize(format)
-        buffer = self.data[start:end].ljust(end - start, b'\x00')
+        end = start + compiled.size
+        if end <= len(self.data):
+            result = compiled.unpack_from(self.data, start)
+        else:
+            # Allow partial overread at the end of the buffer
+            if start >= len(self.data):
+                raise IndexError
+            buffer = bytes(self.data[start:end]).ljust(end - start, b'\x00')
+            result = compiled.unpack(buffer)
 
-        result = struct.unpack(format, buffer)
         if not peek:
             self.offset = end
         return result
 
     def read(self, count, *, peek=False, offset=0):
-        result = self.data[self.offset+offset:self.offset+offset+count]
+        """Returns a zero-copy memoryview of the requested range"""
+        start = self.offset + offset
+        result = memoryview(self.data)[start:start+count]
         if not peek:
             self.offset += count + offset
         return result
 
+    def subreader(self, count):
+        """Returns a reader over the next count bytes without copying"""
+        return BufferReader(self.read(count))
+
+    def read_all_varints(self, max_bits=None):
+        """Decode everything from the current offset to the end of the buffer
+        as back to back varints, for sections made up only of varints"""
+        start = self.offset
+        remaining = bytes(self.data[start:])
+        # Fast path when every varint left is a single byte, checked with
+        # one C level scan instead of a Python loop
+        if remaining.isascii():
+            self.offset = start + len(remaining)
+            return list(remaining)
+
+        # Zero padding past the end makes every u64 window load safe
+        end = len(remaining)
+        data = remaining + bytes(8)
+        offset = 0
+        values = []
+        # Bind hot lookups to locals for the decode loop
+        append = values.append
+        table = VARINT_TABLE
+        unpack_u64 = U64_BE.unpack_from
+        while offset < end:
+            msb = data[offset]
+            if msb < 0x80:
+                append(msb)
+                offset += 1
+                continue
+            if msb < 0xC0:
+                append(((msb & 0x3F) << 8) | data[offset + 1])
+                offset += 2
+                continue
+
+            entry = table[msb]
+            if entry is None:
+                raise HkxException(f"Bad varint encoding mode {msb:02X}")
+            size, window, shift, value_mask = entry
+            if offset + window >= end:
+                # The 9 byte form's marker is the last byte, with no payload
+                raise HkxException(f"Truncated varint at {start + offset:X}")
+            value = unpack_u64(data, offset + window)[0] >> shift
+            append(value & value_mask)
+            offset += size
+        self.offset = start + offset
+
+        if max_bits is not None and len(values) != 0:
+            value = max(values)
+            if (value >> max_bits) != 0:
+                raise HkxException(f"varint is too large: {value:X}, "
+                                   f"bits {max_bits}")
+        return values
+
     def tell(self):
         return self.offset
 
@@ -52,19 +178,33 @@ class BufferReader():
 
 class IndentPrint():
     level = -1
+    # Diagnostic output is off by default when stdout is redirected
+    enabled = sys.stdout.isatty() or bool(os.environ.get("HKX_VERBOSE"))
+    # Lines are buffered and written to stdout in one go by flush()
+    lines = []
+    indents = ["    " * i for i in range(32)]
     @staticmethod
-    def print(*args, **kwargs):
-        print("    " * max(IndentPrint.level, 0), end="")
-        print(*args, **kwargs)
+    def print(*args, sep=" ", end="\n"):
+        if not IndentPrint.enabled:
+            return
+        level = IndentPrint.level
+        if 0 <= level < len(IndentPrint.indents):
+            indent = IndentPrint.indents[level]
+        else:
+            indent = "    " * max(level, 0)
+        IndentPrint.lines.append(indent + sep.join(map(str, args)) + end)
 
-class Section():
-    def __init__(self, flags, size, tag):
-        self.tag = tag
-        self.flags = flags
-        self.total_size = size
-        self.data_size = size - 8
+    @staticmethod
+    def flush():
+        if len(IndentPrint.lines) != 0:
+            sys.stdout.write("".join(IndentPrint.lines))
+            IndentPrint.lines = []
+
+atexit.register(IndentPrint.flush)
 
 class Field():
+    __slots__ = ('name', 'flags', 'offset', 'type')
+
     def __init__(self, name, flags, offset, type):
         self.name = name
         self.flags = flags
@@ -72,19 +212,26 @@ class Field():
         self.type = type
 
 class Interface():
-    def __init__(self, type, name, flags=0):
+    __slots__ = ('type', 'name')
+
+    def __init__(self, type, name):
         self.type = type
         self.name = name
 
 class TemplateParam():
-    def __init__(self, name, value):
+    __slots__ = ('name', 'value', 'is_type')
+
+    def __init__(self, name, value, is_type):
         self.name = name
         self.value = value
-
-    def is_type(self):
-        return self.name[0] == 't'
+        self.is_type = is_type
 
 class Type():
+    __slots__ = ('name', 'template', 'parent', 'opts', 'format', 'subtype',
+                 'version', 'size', 'align', 'flags', 'fields', 'interfaces',
+                 'attribute', 'record_struct', '_hierarchy', '_all_fields',
+                 '_resolved', '_name', '_has_pointers')
+
     def __init__(self):
         self.name       = None
         self.template   = None
@@ -99,17 +246,62 @@ class Type():
         self.fields     = []
         self.interfaces = []
         self.attribute  = None
+        # (struct.Struct, field names, float field indices) for all-primitive
+        # records, else False
+        self.record_struct = None
+        # Filled in by finalize() once the type graph is complete
+        self._hierarchy  = None
+        self._all_fields = None
+        self._resolved   = None
+        # Filled in by get_name() and has_pointers() on first use
+        self._name       = None
+        self._has_pointers = None
+
+    def finalize(self):
+        """Cache lookups that only depend on the finished type graph"""
+        self._hierarchy  = self.hierarchy()
+        self._all_fields = tuple(self.all_fields())
+        self._resolved   = self.resolve()
 
     def hierarchy(self):
+        if self._hierarchy is not None:
+            return self._hierarchy
         typ = self
         types = []
         while typ is not None:
             types.append(typ)
             typ = typ.parent
-        return reversed(types)
+        return tuple(reversed(types))
 
     def all_fields(self):
-        return chain(*[t.fields for t in self.hierarchy()])
+        if self._all_fields is not None:
+            return self._all_fields
+        return chain.from_iterable(t.fields for t in self.hierarchy())
+
+    def has_pointers(self):
+        """Whether a value of this type can refer to other items"""
+        typ = self.resolve()
+        if typ._has_pointers is not None:
+            return typ._has_pointers
+        if typ.format is None:
+            return False
+
+        # Provisional answer in case records contain each other inline
+        typ._has_pointers = False
+        fmt_type = typ.get_format_type()
+        if fmt_type == FormatType.POINTER:
+            result = True
+        elif fmt_type == FormatType.ARRAY:
+            result = (not typ.format & FormatFlag.INLINE_ARRAY or
+                      typ.subtype.has_pointers())
+        elif fmt_type == FormatType.RECORD:
+            result = any(f.type.has_pointers() for f in typ.all_fields())
+        else:
+            # Strings are pointers too, but deserialize_string doesn't
+            # go through deserialize_item
+            result = False
+        typ._has_pointers = result
+        return result
 
     def is_pointer(self):
         return self.name == "T*"
@@ -119,37 +311,47 @@ class Type():
 
     def resolve(self):
         """Resolve type aliases like hkInt32"""
+        if self._resolved is not None:
+            return self._resolved
         typ = self
         while typ.format is None and typ.parent is not None:
             typ = typ.parent
         return typ
 
     def get_name(self):
+        if self._name is not None:
+            return self._name
+
+        # Names and templates are complete once TNA1 is read, so the result
+        # can be cached before the type graph is finalized
         template = self.template
 
         if len(template) == 0:
-            return self.name
-
-        if self.is_pointer():
-            return f"{template[0].value.get_name()}*"
-        if self.is_array():
-            return (f"{template[0].value.get_name()}"
-                    f"[{template[1].value}]")
+            self._name = self.name
+        elif self.is_pointer():
+            self._name = f"{template[0].value.get_name()}*"
+        elif self.is_array():
+            self._name = (f"{template[0].value.get_name()}"
+                          f"[{template[1].value}]")
+        else:
+            params = []
 
-        params = []
+            for param in template:
+                if param.is_type:
+                    params.append(param.value.get_name())
+                else:
+                    params.append(f"{param.value}")
 
-        for param in template:
-            if param.is_type():
-                params.append(param.value.get_name())
-            else:
-                params.append(f"{param.value}")
+            self._name = f"{self.name}<{', '.join(params)}>"
 
-        return f"{self.name}<{', '.join(params)}>"
+        return self._name
 
     def get_format_type(self):
         return self.format & 31
 
 class Item():
+    __slots__ = ('type', 'flags', 'offset', 'count', 'value')
+
     def __init__(self, type, flags, offset, count):
         self.type = type
         self.flags = flags
@@ -163,61 +365,13 @@ class Item():
     def is_array(self):
         return (self.flags & ItemFlag.ARRAY) != 0
 
-def read_string(reader):
-    result = b""
-    while not reader.eof():
-        c = reader.read(1)
-        if c == b'\x00':
-            break
-        result += c
-    return result.decode()
-
 def read_string_section(reader):
-    strings = []
-    while not reader.eof():
-        strings.append(read_string(reader))
-    return strings
-
-def decode_varint(reader):
-    """Returns tuple of size and value"""
-    value, = reader.unpack(">Q", peek=True)
-    msb = bitutil.reverse_extract64(value, 0, 7)
-    mode = msb >> 3
-
-    if mode <= 15:
-        return (1, msb)
-    if mode <= 23:
-        return (2, bitutil.reverse_extract64(value, 2, 16 - 1))
-    if mode <= 27:
-        return (3, bitutil.reverse_extract64(value, 3, 24 - 1))
-    if mode == 28:
-        return (4, bitutil.reverse_extract64(value, 5, 32 - 1))
-    if mode == 29:
-        return (5, bitutil.reverse_extract64(value, 5, 40 - 1))
-    if mode == 30:
-        return (8, bitutil.reverse_extract64(value, 5, 64 - 1))
-    if mode == 31 and (msb & 7) == 0:
-        return (6, bitutil.reverse_extract64(value, 8, 48 - 1))
-    if mode == 31 and (msb & 7) == 1:
-        return (9, reader.unpack(">Q", peek=True, offset=1)[0])
-
-    raise HkxException(f"Bad varint encoding mode {msb:02X}")
-
-def read_varint(reader, max_bits=None):
-    size, value = decode_varint(reader)
-    reader.skip(size)
-    if max_bits is not None and (value >> max_bits) != 0:
-        raise HkxException(f"varint is too large: {value:X}, bits {max_bits}")
-    return value
-
-def read_varint_u16(reader):
-    return read_varint(reader, 16)
-
-def read_varint_s32(reader):
-    return read_varint(reader, 31)
-
-def read_varint_u32(reader):
-    return read_varint(reader, 32)
+    # Interned since these become the keys of every deserialized record
+    parts = bytes(reader.data[reader.offset:]).split(b'\x00')
+    if parts[-1] == b'':
+        parts.pop()
+    reader.offset = len(reader.data)
+    return [sys.intern(part.decode()) for part in parts]
 
 class Opt():
     FORMAT     = 0x00000001
@@ -252,7 +406,52 @@ class ItemFlag():
     POINTER = 0x10
     ARRAY   = 0x20
 
-def read_opts(reader):
+INT_FORMAT_MASK = (FormatFlag.SIGNED | FormatFlag.INT8 | FormatFlag.INT16 |
+                   FormatFlag.INT32 | FormatFlag.INT64)
+
+def build_int_format_table():
+    """Map the sign and width bits of an int format to a struct format.
+    The narrowest width flag wins if several are set."""
+    WIDTHS = [
+        (FormatFlag.INT8,  "b"),
+        (FormatFlag.INT16, "h"),
+        (FormatFlag.INT32, "i"),
+        (FormatFlag.INT64, "q")
+    ]
+    table = {}
+    for bits in range(1 << 4):
+        width_flags = bits * FormatFlag.INT8
+        char = next((c for flag, c in WIDTHS if width_flags & flag), None)
+        for signed in [0, FormatFlag.SIGNED]:
+            if char is None:
+                table[width_flags | signed] = None
+            elif signed:
+                table[width_flags | signed] = f"<{char}"
+            else:
+                table[width_flags | signed] = f"<{char.upper()}"
+    return table
+
+INT_FORMATS = build_int_format_table()
+INT_STRUCTS = {flags: None if format is None else compile_struct(format)
+               for flags, format in INT_FORMATS.items()}
+
+def primitive_format(typ):
+    """struct format for a resolved bool/int/float type"""
+    fmt = typ.format
+    if fmt is None:
+        return None
+    fmt_type = typ.get_format_type()
+
+    if fmt_type == FormatType.BOOL:
+        return "?"
+    if fmt_type == FormatType.FLOAT:
+        return "<f"
+    if fmt_type == FormatType.INT:
+        return INT_FORMATS[fmt & INT_FORMAT_MASK]
+    return None
+
+def build_opt_table():
+    """Map the serialized opts bits to their Opt values"""
     FLAGS = [
         Opt.FORMAT,
         Opt.SUBTYPE,
@@ -263,25 +462,39 @@ def read_opts(reader):
         Opt.INTERFACES,
         Opt.ATTRIBUTE
     ]
-    value = read_varint_u32(reader)
-    return sum(flag for i, flag in enumerate(FLAGS) if value & (1 << i))
+    return [sum(flag for i, flag in enumerate(FLAGS) if value & (1 << i))
+            for value in range(1 << len(FLAGS))]
+
+OPT_TABLE = build_opt_table()
+
+def check_varint_bits(value, max_bits):
+    """Range check for a value taken from BufferReader.read_all_varints"""
+    if (value >> max_bits) != 0:
+        raise HkxException(f"varint is too large: {value:X}, bits {max_bits}")
+    return value
+
+SECTION_SIZE_MASK = (1 << 30) - 1
 
 def read_section(reader):
-    size_and_flags, tag = reader.unpack(">I4s")
-    flags = size_and_flags >> 30
-    size = size_and_flags & ((1 << 30) - 1)
-    return Section(flags, size, tag.decode())
+    """Returns tuple of flags, total size including the header, and tag"""
+    size_and_flags, tag = reader.unpack_struct(SECTION_HEADER)
+    return (size_and_flags >> 30, size_and_flags & SECTION_SIZE_MASK, tag)
 
 def read_sections(reader, section_handlers):
     IndentPrint.level += 1
 
-    while not reader.eof():
-        header = read_section(reader)
-        if header.tag in section_handlers:
-            section_handlers[header.tag](reader, header)
+    # Bind hot lookups to locals for the section loop
+    get_handler = section_handlers.get
+    end = len(reader.data)
+    while reader.offset < end:
+        _, size, tag = read_section(reader)
+        # Handlers are passed the size of the data after the header
+        handler = get_handler(tag)
+        if handler is not None:
+            handler(reader, size - SECTION_HEADER.size)
         else:
-            IndentPrint.print(header.tag)
-            reader.skip(header.data_size)
+            IndentPrint.print(tag.decode())
+            reader.offset += size - SECTION_HEADER.size
 
     IndentPrint.level -= 1
 
@@ -292,149 +505,183 @@ class HkxParser():
         self.fstr = None
         self.types = None
         self.items = None
-
-    def TAG0(self, reader, header):
-        read_sections(BufferReader(reader.read(header.data_size)), {
-            'DATA': self.DATA,
-            'INDX': self.INDX,
-            'SDKV': self.SDKV,
-            'TYPE': self.TYPE,
+        # When set, deserialize_item collects items here instead of reading
+        self.child_items = None
+        # Set once a NaN or infinite float has been deserialized
+        self.non_finite = False
+
+    def TAG0(self, reader, size):
+        read_sections(reader.subreader(size), {
+            b'DATA': self.DATA,
+            b'INDX': self.INDX,
+            b'SDKV': self.SDKV,
+            b'TYPE': self.TYPE,
         })
 
-    def DATA(self, reader, header):
+    def DATA(self, reader, size):
         IndentPrint.print("DATA")
-        self.data = BufferReader(reader.read(header.data_size))
+        self.data = reader.subreader(size)
 
-    def INDX(self, reader, header):
+    def INDX(self, reader, size):
         IndentPrint.print("INDX")
-        read_sections(BufferReader(reader.read(header.data_size)), {
-            'ITEM': self.ITEM
+        read_sections(reader.subreader(size), {
+            b'ITEM': self.ITEM
         })
 
-    def ITEM(self, reader, header):
+    def ITEM(self, reader, size):
         IndentPrint.print("ITEM")
-        inner = BufferReader(reader.read(header.data_size))
+        inner = reader.subreader(size)
         IndentPrint.level += 1
-        self.items = []
-        while not inner.eof():
-            self.items.append(self.read_item(inner))
+        # Unpack every fixed size entry in one pass
+        count = size // ITEM_ENTRY.size
+        entries = ITEM_ENTRY.iter_unpack(inner.data[:count*ITEM_ENTRY.size])
+        self.items = [self.make_item(*entry) for entry in entries]
         IndentPrint.level -= 1
 
-    def SDKV(self, reader, header):
-        IndentPrint.print(f"SDKV: {reader.read(header.data_size).decode()}")
+    def SDKV(self, reader, size):
+        sdk_version = bytes(reader.read(size)).decode()
+        IndentPrint.print(f"SDKV: {sdk_version}")
 
-    def TYPE(self, reader, header):
+    def TYPE(self, reader, size):
         IndentPrint.print("TYPE")
-        read_sections(BufferReader(reader.read(header.data_size)), {
-            'TSTR': self.TSTR,
-            'TNA1': self.TNA1,
-            'FSTR': self.FSTR,
-            'TBDY': self.TBDY
+        read_sections(reader.subreader(size), {
+            b'TSTR': self.TSTR,
+            b'TNA1': self.TNA1,
+            b'FSTR': self.FSTR,
+            b'TBDY': self.TBDY
         })
 
-    def TSTR(self, reader, header):
+    def TSTR(self, reader, size):
         IndentPrint.print("TSTR")
         if self.tstr is not None:
             raise HkxException("Found multiple TSTR sections")
-        inner = BufferReader(reader.read(header.data_size))
+        inner = reader.subreader(size)
         self.tstr = read_string_section(inner)
 
-    def TNA1(self, reader, header):
+    def TNA1(self, reader, size):
         IndentPrint.print("TNA1")
         if self.types is not None:
             raise HkxException("Found multiple TNA1 sections")
-        inner = BufferReader(reader.read(header.data_size))
-        count = read_varint_s32(inner)
+        inner = reader.subreader(size)
+        # The section is all s32 varints, so decode it in one pass
+        values = iter(inner.read_all_varints(31))
+        count = next(values)
         IndentPrint.level += 1
-        self.types = [None] + [Type() for _ in range(1, count)]
+        self.types = [None] * count
         for i in range(1, count):
-            self.read_type_identity(inner, self.types[i])
+            self.types[i] = Type()
+        for i in range(1, count):
+            self.read_type_identity(values, self.types[i])
         IndentPrint.level -= 1
 
-    def FSTR(self, reader, header):
+    def FSTR(self, reader, size):
         IndentPrint.print("FSTR")
         if self.fstr is not None:
             raise HkxException("Found multiple FSTR sections")
-        inner = BufferReader(reader.read(header.data_size))
+        inner = reader.subreader(size)
         self.fstr = read_string_section(inner)
 
-    def TBDY(self, reader, header):
+    def TBDY(self, reader, size):
         IndentPrint.print("TBDY")
-        inner = BufferReader(reader.read(header.data_size))
+        inner = reader.subreader(size)
+        # The section is all varints, so decode it in one pass. Narrower
+        # values are range checked by read_type_body.
+        values = iter(inner.read_all_varints(32))
         IndentPrint.level += 1
-        while not inner.eof():
-            self.read_type_body(inner)
+        for id in values:
+            self.read_type_body(id, values)
         IndentPrint.level -= 1
-
-    def read_type_identity(self, reader, typ):
-        typ.name        = self.tstr[read_varint_s32(reader)]
-        typ.template    = []
-        for _ in range(read_varint_s32(reader)):
-            param_name = self.tstr[read_varint_s32(reader)]
-            if param_name[0] == 't':
-                param_value = self.types[read_varint_s32(reader)]
+        for typ in self.types[1:]:
+            typ.finalize()
+
+    def read_type_identity(self, values, typ):
+        """Read a TNA1 entry from an iterator of predecoded varints"""
+        tstr = self.tstr
+        types = self.types
+
+        typ.name        = tstr[next(values)]
+        typ.template    = template = [None] * next(values)
+        for i in range(len(template)):
+            param_name = tstr[next(values)]
+            is_type = param_name[0] == 't'
+            if is_type:
+                param_value = types[next(values)]
             else:
-                param_value = read_varint_s32(reader)
-            typ.template.append(TemplateParam(param_name, param_value))
+                param_value = next(values)
+            template[i] = TemplateParam(param_name, param_value, is_type)
 
-    def read_type_body(self, reader):
-        id = read_varint_s32(reader)
+    def read_type_body(self, id, values):
+        """Read a TBDY entry from an iterator of predecoded u32 varints. Type
+        ids are range checked by indexing the type table."""
         if id == 0:
             return
 
-        typ = self.types[id]
-        typ.parent = self.types[read_varint_s32(reader)]
-        typ.opts = read_opts(reader)
+        types = self.types
+        typ = types[id]
+        typ.parent = types[next(values)]
+        # Only the low 8 bits of the opts are meaningful
+        typ.opts = opts = OPT_TABLE[next(values) & 0xFF]
 
-        if typ.opts & Opt.FORMAT:
-            typ.format = read_varint_u32(reader)
-        if typ.opts & Opt.SUBTYPE:
+        if opts & Opt.FORMAT:
+            typ.format = next(values)
+        if opts & Opt.SUBTYPE:
             if typ.format == 0:
                 raise HkxException("Invalid type with Opt::SUBTYPE optional "
                                    "but no Opt::FORMAT.")
-            typ.subtype = self.types[read_varint_s32(reader)]
-        if typ.opts & Opt.VERSION:
-            typ.version = read_varint_s32(reader)
-        if typ.opts & Opt.SIZE_ALIGN:
-            typ.size  = read_varint_u32(reader)
-            typ.align = read_varint_u32(reader)
-        if typ.opts & Opt.FLAGS:
-            typ.flags = read_varint_u16(reader)
-        if typ.opts & Opt.FIELDS:
-            field_count_pair  = read_varint_s32(reader)
-            field_count       = bitutil.extract(field_count_pair, 0, 15)
-            placeholder_count = bitutil.extract(field_count_pair, 16, 31)
-            for _ in range(field_count):
-                field_name   = self.fstr[read_varint_u16(reader)]
-                field_flags  = read_varint_u16(reader)
-                field_offset = read_varint_u16(reader)
-                field_type   = self.types[read_varint_s32(reader)]
-                typ.fields.append(Field(field_name, field_flags, field_offset,
-                                        field_type))
-        if typ.opts & Opt.INTERFACES:
-            interface_count = read_varint_s32(reader)
-            for _ in range(interface_count):
-                interface_type = self.types[read_varint_s32(reader)]
-                interface_name = self.fstr[read_varint_s32(reader)]
-                typ.interfaces.append(Interface(interface_type, interface_name))
-        if typ.opts & Opt.ATTRIBUTE:
-            typ.attribute = read_varint_s32(reader)
-
+            typ.subtype = types[next(values)]
+        if opts & Opt.VERSION:
+            typ.version = check_varint_bits(next(values), 31)
+        if opts & Opt.SIZE_ALIGN:
+            typ.size  = next(values)
+            typ.align = next(values)
+        if opts & Opt.FLAGS:
+            typ.flags = check_varint_bits(next(values), 16)
+        if opts & Opt.FIELDS:
+            field_count_pair  = check_varint_bits(next(values), 31)
+            field_count       = field_count_pair & 0xFFFF
+            placeholder_count = (field_count_pair >> 16) & 0xFFFF
+            # Bind hot lookups to locals for the field loop
+            fstr = self.fstr
+            typ.fields = fields = [None] * field_count
+            for i in range(field_count):
+                # Name, flags and offset are u16, type is s32
+                name_id      = next(values)
+                field_flags  = next(values)
+                field_offset = next(values)
+                type_id      = next(values)
+                if (name_id | field_flags | field_offset) >> 16 != 0:
+                    raise HkxException("Field varint is too large for u16")
+                fields[i] = Field(fstr[name_id], field_flags, field_offset,
+                                  types[type_id])
+        if opts & Opt.INTERFACES:
+            interface_count = check_varint_bits(next(values), 31)
+            typ.interfaces = interfaces = [None] * interface_count
+            for i in range(interface_count):
+                interface_type = types[next(values)]
+                interface_name = self.fstr[next(values)]
+                interfaces[i] = Interface(interface_type, interface_name)
+        if opts & Opt.ATTRIBUTE:
+            typ.attribute = check_varint_bits(next(values), 31)
+
+        if IndentPrint.enabled:
+            self.print_type_body(id, typ)
+
+    def print_type_body(self, id, typ):
         IndentPrint.print(f"type body {id}: {typ.get_name()}")
         IndentPrint.level += 1
 
         if typ.parent is not None:
             IndentPrint.print(f"parent    {typ.parent.get_name()}")
-        IndentPrint.print(f"opts      {typ.opts:08X}")
+        IndentPrint.print("opts      %08X" % typ.opts)
         if typ.format is not None:
-            IndentPrint.print(f"format    {typ.format:08X} "
-                                       f"({typ.get_format_type()})")
+            IndentPrint.print("format    %08X (%d)" % (typ.format,
+                                                     typ.get_format_type()))
         if typ.subtype is not None:
             IndentPrint.print(f"subtype   {typ.subtype.get_name()}")
         if typ.version is not None:
             IndentPrint.print(f"version   {typ.version}")
         if typ.flags is not None:
-            IndentPrint.print(f"flags     {typ.flags:02X}")
+            IndentPrint.print("flags     %02X" % typ.flags)
         if typ.size is not None:
             IndentPrint.print(f"size      {typ.size}")
             IndentPrint.print(f"align     {typ.align}")
@@ -444,8 +691,9 @@ class HkxParser():
             IndentPrint.print("fields")
             IndentPrint.level += 1
             for field in typ.fields:
-                IndentPrint.print(f"{field.offset:02X}: "
-                                  f"{field.type.get_name()} {field.name}")
+                IndentPrint.print("%02X: %s %s" % (field.offset,
+                                                   field.type.get_name(),
+                                                   field.name))
             IndentPrint.level -= 1
         if len(typ.interfaces) != 0:
             IndentPrint.print("interfaces")
@@ -457,35 +705,80 @@ class HkxParser():
 
         IndentPrint.level -= 1
 
-    def read_item(self, reader):
-        type_and_flags, offset, count = reader.unpack("<III")
-        type_id = bitutil.extract(type_and_flags, 0, 23)
-        flags   = bitutil.extract(type_and_flags, 24, 31)
+    def make_item(self, type_and_flags, offset, count):
+        type_id = type_and_flags & 0xFFFFFF
+        flags   = (type_and_flags >> 24) & 0xFF
         if type_id == 0:
             return None
         typ = self.types[type_id]
-        IndentPrint.print("item")
-        IndentPrint.level += 1
-        IndentPrint.print(f"type   {typ.get_name()}")
-        IndentPrint.print(f"flags  {flags:02X}")
-        IndentPrint.print(f"offset {offset:08X}")
-        IndentPrint.print(f"count  {count}")
-        IndentPrint.level -= 1
+        if IndentPrint.enabled:
+            IndentPrint.print("item")
+            IndentPrint.level += 1
+            IndentPrint.print(f"type   {typ.get_name()}")
+            IndentPrint.print("flags  %02X" % flags)
+            IndentPrint.print("offset %08X" % offset)
+            IndentPrint.print(f"count  {count}")
+            IndentPrint.level -= 1
         return Item(typ, flags, offset, count)
 
     def read_pointer(self, reader):
-        return self.items[reader.unpack("<Q")[0]]
+        return self.items[reader.unpack_struct(POINTER)[0]]
+
+    def find_child_items(self, item):
+        """Items directly referenced by item's data"""
+        # Skip walking data that can't refer to other items, like big
+        # primitive arrays
+        if not item.type.has_pointers():
+            return []
+        reader = self.data
+        saved = reader.tell()
+        reader.seek(item.offset)
+        self.child_items = []
+        for _ in range(item.count if item.is_array() else 1):
+            self.deserialize_object(reader, item.type)
+        children, self.child_items = self.child_items, None
+        reader.seek(saved)
+        return children
+
+    def split_items(self, root, count):
+        """Expand the item graph breadth first from root until there are at
+        least count subtrees that can be deserialized independently"""
+        frontier = [root]
+        expanded = set()
+        while len(frontier) < count:
+            next_frontier = []
+            for item in frontier:
+                children = None
+                if id(item) not in expanded:
+                    expanded.add(id(item))
+                    children = self.find_child_items(item)
+                next_frontier.extend(children if children else [item])
+            # Deduplicate while keeping order
+            next_frontier = list({id(i): i for i in next_frontier}.values())
+            if next_frontier == frontier:
+                break
+            frontier = next_frontier
+        return frontier
 
     def deserialize_item(self, reader, item):
         if item is None:
             return None
+        if self.child_items is not None:
+            self.child_items.append(item)
+            return None
         if item.value is None:
-            item_reader = reader.clone(offset=item.offset)
+            # Reuse the caller's reader and put it back where it was
+            saved = reader.tell()
+            reader.seek(item.offset)
             if item.is_array():
-                item.value = [self.deserialize_object(item_reader, item.type)
-                                                for _ in range(item.count)]
+                item.value = self.unpack_primitive_array(reader, item.type,
+                                                         item.count)
+                if item.value is None:
+                    item.value = [self.deserialize_object(reader, item.type)
+                                                    for _ in range(item.count)]
             else:
-                item.value = self.deserialize_object(item_reader, item.type)
+                item.value = self.deserialize_object(reader, item.type)
+            reader.seek(saved)
         # Return cached value
         return item.value
 
@@ -494,68 +787,150 @@ class HkxParser():
             return None
         if not item.is_array():
             raise HkxException("Unexpected non-array")
-        return reader.clone(offset=item.offset).read(item.count - 1).decode()
+        start = item.offset
+        return bytes(reader.data[start:start+item.count-1]).decode()
 
-    def deserialize_object_impl(self, reader, typ, name):
-        fmt = typ.format
-        fmt_type = typ.get_format_type()
+    def build_record_struct(self, typ):
+        """Build a single struct covering a record made only of primitives.
+        Returns None if any field needs the general path."""
+        if typ.align is None:
+            return None
 
-        if fmt_type == FormatType.BOOL:
-            return reader.unpack("?")[0]
+        fields = list(typ.all_fields())
+        format = "<"
+        end = 0
+        for f in fields:
+            field_typ = f.type.resolve()
+            field_format = primitive_format(field_typ)
+            # Fields must be in offset order for names to match values
+            if field_format is None or f.offset < end:
+                return None
+            size = struct.calcsize(field_format)
+            if field_typ.size is not None and field_typ.size != size:
+                return None
+            align = field_typ.align
+            if align is not None and (typ.align % align != 0 or
+                                      f.offset % align != 0):
+                return None
+            if f.offset > end:
+                format += f"{f.offset - end}x"
+            # Drop the byte order prefix, the record has its own
+            format += field_format.lstrip("<")
+            end = f.offset + size
+
+        # Float positions in the unpacked values, for the non-finite check
+        float_indices = tuple(i for i, f in enumerate(fields)
+                              if f.type.resolve().get_format_type() ==
+                                 FormatType.FLOAT)
+        return (struct.Struct(format), tuple(f.name for f in fields),
+                float_indices)
+
+    def unpack_primitive_array(self, reader, typ, count):
+        """Unpack count back to back primitives in a single call. Returns None
+        if typ is not a primitive packed at its natural size."""
+        typ = typ.resolve()
+        element_format = primitive_format(typ)
+        if element_format is None:
+            return None
+        size = struct.calcsize(element_format)
+        if typ.size is not None and typ.size != size:
+            return None
 
-        if fmt_type == FormatType.STRING:
-            return self.deserialize_string(reader, self.read_pointer(reader))
+        offset = reader.tell()
+        align = typ.align
+        if align is not None and (size % align != 0 or offset % align != 0):
+            return None
+        end = offset + size * count
+        if end > len(reader.data):
+            return None
 
-        if fmt_type == FormatType.INT:
-            if fmt & FormatFlag.INT8:
-                if fmt & FormatFlag.SIGNED:
-                    return reader.unpack("<b")[0]
-                else:
-                    return reader.unpack("<B")[0]
-            if fmt & FormatFlag.INT16:
-                if fmt & FormatFlag.SIGNED:
-                    return reader.unpack("<h")[0]
-                else:
-                    return reader.unpack("<H")[0]
-            if fmt & FormatFlag.INT32:
-                if fmt & FormatFlag.SIGNED:
-                    return reader.unpack("<i")[0]
-                else:
-                    return reader.unpack("<I")[0]
-            if fmt & FormatFlag.INT64:
-                if fmt & FormatFlag.SIGNED:
-                    return reader.unpack("<q")[0]
-                else:
-                    return reader.unpack("<Q")[0]
+        format = f"<{count}{element_format.lstrip('<')}"
+        result = list(struct.unpack_from(format, reader.data, offset))
+        reader.seek(end)
+        if element_format == "<f" and not all(map(isfinite, result)):
+            self.non_finite = True
+        return result
+
+    def deserialize_bool(self, reader, typ):
+        return reader.unpack_struct(BOOL)[0]
+
+    def deserialize_string_pointer(self, reader, typ):
+        return self.deserialize_string(reader, self.read_pointer(reader))
+
+    def deserialize_int(self, reader, typ):
+        compiled = INT_STRUCTS[typ.format & INT_FORMAT_MASK]
+        if compiled is None:
             raise NotImplementedError
+        return reader.unpack_struct(compiled)[0]
+
+    def deserialize_float(self, reader, typ):
+        value = reader.unpack_struct(FLOAT)[0]
+        if not isfinite(value):
+            self.non_finite = True
+        return value
+
+    def deserialize_pointer(self, reader, typ):
+        item = self.read_pointer(reader)
+        if item is not None and typ.subtype not in item.type.hierarchy():
+            if typ.subtype.get_format_type() != FormatType.OPAQUE:
+                raise HkxException("Unexpected pointer type")
+        return self.deserialize_item(reader, item)
+
+    def deserialize_array(self, reader, typ):
+        if not typ.format & FormatFlag.INLINE_ARRAY:
+            return self.deserialize_pointer(reader, typ)
+
+        element_size = typ.subtype.resolve().size
+        if element_size and typ.size % element_size == 0:
+            result = self.unpack_primitive_array(reader, typ.subtype,
+                                                 typ.size // element_size)
+            if result is not None:
+                return result
+
+        offset = reader.tell()
+        result = []
+        while reader.tell() < offset + typ.size:
+            result.append(self.deserialize_object(reader, typ.subtype))
+        return result
+
+    def deserialize_record(self, reader, typ):
+        offset = reader.tell()
+        if typ.record_struct is None:
+            typ.record_struct = self.build_record_struct(typ) or False
+        if typ.record_struct:
+            compiled, names, float_indices = typ.record_struct
+            end = offset + compiled.size
+            if end <= len(reader.data):
+                reader.seek(end)
+                values = compiled.unpack_from(reader.data, offset)
+                for i in float_indices:
+                    if not isfinite(values[i]):
+                        self.non_finite = True
+                return dict(zip(names, values))
+
+        result = {}
+        for f in typ.all_fields():
+            reader.seek(offset + f.offset)
+            result[f.name] = self.deserialize_object(reader, f.type, f.name)
+        return result
+
+    FORMAT_HANDLERS = {
+        FormatType.BOOL:    deserialize_bool,
+        FormatType.STRING:  deserialize_string_pointer,
+        FormatType.INT:     deserialize_int,
+        FormatType.FLOAT:   deserialize_float,
+        FormatType.POINTER: deserialize_pointer,
+        FormatType.RECORD:  deserialize_record,
+        FormatType.ARRAY:   deserialize_array,
+    }
 
-        if fmt_type == FormatType.FLOAT:
-            return reader.unpack("<f")[0]
-
-        if fmt_type == FormatType.ARRAY and fmt & FormatFlag.INLINE_ARRAY:
-            offset = reader.tell()
-            result = []
-            while reader.tell() < offset + typ.size:
-                result.append(self.deserialize_object(reader, typ.subtype))
-            return result
-
-        if fmt_type in [FormatType.POINTER, FormatType.ARRAY]:
-            item = self.read_pointer(reader)
-            if item is not None and typ.subtype not in item.type.hierarchy():
-                if typ.subtype.get_format_type() != FormatType.OPAQUE:
-                    raise HkxException("Unexpected pointer type")
-            return self.deserialize_item(reader, item)
-
-        if fmt_type == FormatType.RECORD:
-            offset = reader.tell()
-            result = {}
-            for f in typ.all_fields():
-                reader.seek(offset + f.offset)
-                result[f.name] = self.deserialize_object(reader, f.type, f.name)
-            return result
-
-        print(f"Unimplemented format type {fmt_type}")
-        raise NotImplementedError
+    def deserialize_object_impl(self, reader, typ, name):
+        fmt_type = typ.get_format_type()
+        handler = self.FORMAT_HANDLERS.get(fmt_type)
+        if handler is None:
+            print(f"Unimplemented format type {fmt_type}")
+            raise NotImplementedError
+        return handler(self, reader, typ)
 
     def deserialize_object(self, reader, typ, name=None):
         real_typ = typ.resolve()
@@ -568,20 +943,108 @@ class HkxParser():
             reader.seek(offset + real_typ.size)
         return value
 
-def main():
-    if len(sys.argv) < 3:
-        print("Usage: hkx-parser.py <input.hkx> <output.json>", file=sys.stderr)
-        sys.exit(1)
-
-    with open(sys.argv[1], "rb") as f:
-        data = f.read()
-
+# Parser state for each process pool worker, see init_worker
+worker_parser = None
+
+def init_worker(path):
+    global worker_parser
+    IndentPrint.enabled = False
+    # Left open for the lifetime of the worker process
+    f = open(path, "rb")
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    worker_parser = HkxParser()
+    read_sections(BufferReader(data), {b'TAG0': worker_parser.TAG0})
+
+def deserialize_in_worker(index):
+    """Returns tuple of the item's value and whether the worker has
+    deserialized any non-finite floats so far"""
+    hkx = worker_parser
+    value = hkx.deserialize_item(hkx.data, hkx.items[index])
+    return (value, hkx.non_finite)
+
+def parse_root(data, path=None, jobs=1):
+    """Deserialize the root item. Returns tuple of its value and whether it
+    contains any NaN or infinite floats. Section readers hold memoryviews of
+    data.
+    They are all released when this returns, but if it raises, the traceback
+    can keep them alive until the exception is freed.
+
+    With jobs > 1, independent subtrees of the item graph are deserialized
+    by a pool of worker processes that each reparse the file at path."""
     hkx = HkxParser()
-    read_sections(BufferReader(data), {'TAG0': hkx.TAG0})
-    value = hkx.deserialize_item(hkx.data, hkx.items[1])
+    read_sections(BufferReader(data), {b'TAG0': hkx.TAG0})
+    root = hkx.items[1]
+
+    if jobs > 1:
+        subtrees = [item for item in hkx.split_items(root, jobs)
+                    if item is not root]
+        if len(subtrees) > 1:
+            indices = {id(item): i for i, item in enumerate(hkx.items)}
+            subtree_indices = [indices[id(item)] for item in subtrees]
+            with ProcessPoolExecutor(jobs, initializer=init_worker,
+                                     initargs=(path,)) as pool:
+                results = pool.map(deserialize_in_worker, subtree_indices)
+                # Cached values are picked up when deserializing the root
+                for item, (value, non_finite) in zip(subtrees, results):
+                    item.value = value
+                    hkx.non_finite |= non_finite
+
+    value = hkx.deserialize_item(hkx.data, root)
+    return (value, hkx.non_finite)
+
+def job_count(value):
+    """argparse type for --jobs"""
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f"invalid job count: {value}")
+    return jobs
 
-    with open(sys.argv[2], "w") as f:
-        print(json.dump(value, f, indent=4))
+def main():
+    parser = argparse.ArgumentParser(prog="hkx-parser.py")
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose", action="store_true",
+                           help="print the section and type tree")
+    verbosity.add_argument("-q", "--quiet", action="store_true",
+                           help="don't print the section and type tree")
+    parser.add_argument("-j", "--jobs", type=job_count, default=1,
+                        metavar="N", help="deserialize with N worker processes")
+    parser.add_argument("input", help="input .hkx file")
+    parser.add_argument("output", help="output .json file")
+    args = parser.parse_args()
+
+    # Without either flag, output is on when stdout is a terminal
+    if args.verbose:
+        IndentPrint.enabled = True
+    elif args.quiet:
+        IndentPrint.enabled = False
+
+    # Map the input rather than reading it so pages are only faulted in as
+    # sections are visited
+    with open(args.input, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            value, non_finite = parse_root(data, args.input, args.jobs)
+        finally:
+            try:
+                data.close()
+            except BufferError:
+                # A failed parse's traceback still holds section views. The
+                # map is unmapped once they go, and the parse error is what
+                # gets reported.
+                pass
+    IndentPrint.flush()
+
+    # orjson writes non-finite floats as null, so it's only used when the
+    # output would match what json writes
+    if orjson is not None and not non_finite:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(value, option=orjson.OPT_INDENT_2))
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(value, f, indent=2, ensure_ascii=False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file